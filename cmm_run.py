@@ -3,23 +3,24 @@ import sys
 import argparse
 import asyncio
 
-sys.path.append(os.path.dirname(__file__))
-import src.utils
+if __package__ is None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from src import utils
 
 async def main(input_folder, format, n_cpus, n_files_per_div, verbose, headless, run):
-    data = src.utils.get_data(input_folder, format, verbose)
+    data = utils.get_data(input_folder, format, verbose)
     args = (data, verbose, n_cpus, n_files_per_div, headless)
-    src.utils.TIMEOUT = src.utils.TIMEOUT_30s
+    utils.TIMEOUT = utils.TIMEOUT_30s
 
     if run:
-        out, _ = await src.utils.submit(*args)
-        src.utils.save_json(out, "run.json")
-    else: src.utils.dry(data, args)
+        out, _ = await utils.submit(*args)
+        utils.save_json(out, "run.json")
+    else: utils.dry(data, args)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Submit volumes for processing.")
     parser.add_argument("-i", "--input_folder", type=str, default="volumes", help="Path to input folder")
-    parser.add_argument("-f", "--format", type=str, default="pdb,mrc", help="File formats for model and volume")
+    parser.add_argument("-f", "--format", type=str, default="pdb,mrc", help="File formats for model and volume, e.g. 'pdb,mrc' or 'pdb,cif:mrc,map'")
     parser.add_argument("-c", "--n_cpus", type=int, default=1, help="Number of CPUs to use")
     parser.add_argument("-n", "--n_files_per_div", type=int, default=1, help="Files per division")
     parser.add_argument("-v", "--verbose", type=int, default=1, help="Verbosity level")
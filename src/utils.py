@@ -1,15 +1,16 @@
 import os
 import sys
 import json
-import math
-import numpy as np
+import textwrap
+from collections import deque
+from dataclasses import dataclass, asdict
+from itertools import chain
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import asyncio
-import playwright
-from playwright.async_api import async_playwright
-
-from tqdm import tqdm
-from tqdm.asyncio import tqdm_asyncio
 
 TIMEOUT_1h  = 3600000   # 60 min
 TIMEOUT_30m = 1800000   # 30 min
@@ -26,6 +27,39 @@ TIMEOUT_1s  =     1000  #  1 sec
 
 TIMEOUT = TIMEOUT_3s
 
+@dataclass(slots=True, frozen=True)
+class Dataset:
+    """
+    Information about a single input dataset.
+
+    Attributes
+    ----------
+    i : int
+        Index of the dataset.
+    id : str
+        Unique identifier for the dataset.
+    dir : str
+        Path to the dataset folder.
+    vol : str
+        Volume file name.
+    pdb : str
+        PDB file name.
+    fvol : str
+        Absolute path to the volume file.
+    fpdb : str
+        Absolute path to the pdb file.
+    fout : str
+        Absolute path to the output json file.
+    """
+    i: int
+    id: str
+    dir: str
+    vol: str
+    pdb: str
+    fvol: str
+    fpdb: str
+    fout: str
+
 def get_data(input_folder, extensions="pdb,mrc", verbose=1):
     """
     Extract input data information from a given folder.
@@ -35,137 +69,269 @@ def get_data(input_folder, extensions="pdb,mrc", verbose=1):
     input_folder : str
         Folder containing subfolders with volume and pdb files.
     extensions : str, optional
-        Comma-separated list of file extensions to consider. Default is "pdb,mrc".
+        Model and volume file extensions, as "model,volume" (e.g. "pdb,mrc"), or as
+        "models:volumes" with comma-separated extensions in each group (e.g. "pdb,cif:mrc,map").
+        Default is "pdb,mrc".
     verbose : int, optional
         Verbosity level. 0 is quiet, 1 is verbose. Default is 1.
 
     Returns
     -------
-    data : list of dict
-        List of dictionaries containing information about each dataset.
-        Each dictionary has keys:
-            - i: index of dataset
-            - id: unique identifier for dataset
-            - dir: path to dataset folder
-            - vol: volume file name
-            - pdb: pdb file name
-            - fvol: absolute path to volume file
-            - fpdb: absolute path to pdb file
-            - fout: absolute path to output json file
+    data : list of Dataset
+        List with the information about each dataset.
     """
     if verbose: print(f" - Extracting input data info...")
-    pdb_format, vol_format = "." + np.array(extensions.split(","))
+    groups = extensions.split(":") if ":" in extensions else extensions.split(",")
+    pdb_format, vol_format = (tuple("." + ext for ext in group.split(",")) for group in groups)
     input_folder = os.path.abspath(input_folder)
 
-    vids = [f for f in os.listdir(input_folder) if not f.startswith(".") and os.path.isdir(os.path.join(input_folder, f))]
+    with os.scandir(input_folder) as it:
+        vids = [e for e in it if not e.name.startswith(".") and e.is_dir()]
     data = []
     for i, vid in enumerate(vids):
-        folder = f"{input_folder}/{vid}"
-        vis = [f for f in os.listdir(folder) if f.endswith(vol_format)]
-        pis = [f for f in os.listdir(folder) if f.endswith(pdb_format)]
+        folder = vid.path
+        vis, pis = [], []
+        with os.scandir(folder) as it:
+            for e in it:
+                if e.name.endswith(vol_format): vis.append(e)
+                elif e.name.endswith(pdb_format): pis.append(e)
         if len(vis) > 1 or len(pis) > 1: raise Exception(f"Multiple volumes or pdbs in: {folder}")
         if len(vis) < 1: raise FileNotFoundError(f"Could not find volume in: {folder}")
         if len(pis) < 1: raise FileNotFoundError(f"Could not find pdb in: {folder}")
-        data.append({
-            "i": i,
-            "id": vid + "-" + vis[0].split(".")[0],
-            "dir": folder,
-            "vol": vis[0],
-            "pdb": pis[0],
-            "fvol": os.path.abspath(f"{folder}/{vis[0]}"),
-            "fpdb": os.path.abspath(f"{folder}/{pis[0]}"),
-            "fout": os.path.abspath(f"{folder}/CMM_results.json")
-        })
+        data.append(Dataset(
+            i=i,
+            id=vid.name + "-" + vis[0].name.split(".")[0],
+            dir=folder,
+            vol=vis[0].name,
+            pdb=pis[0].name,
+            fvol=vis[0].path,
+            fpdb=pis[0].path,
+            fout=os.path.join(folder, "CMM_results.json")
+        ))
     if verbose: print(f"   Total dataset length: {len(data)}")
     return data
 
-async def get_context(p, headless, timeout):
+async def get_browser(p, headless):
     """
-    Launch a new browser context with a specific user agent and viewport.
-    
+    Launch the browser shared by all the sessions.
+
     Parameters
     ----------
     p: playwright.playwright.Playwright
         The Playwright instance.
     headless: bool
         Whether to launch the browser in headless mode.
-    timeout: int
-        The default timeout for the context.
-    
+
     Returns
     -------
     browser: playwright.chromium.Browser
         The launched browser.
+    """
+    return await p.chromium.launch(headless=headless)
+
+async def new_isolated_context(browser, timeout):
+    """
+    Create a new browser context with a specific user agent and viewport.
+
+    Every page of the context has the navigator.webdriver property and the
+    navigator.mediaDevices.enumerateDevices method disabled.
+
+    Parameters
+    ----------
+    browser: playwright.chromium.Browser
+        The shared browser instance.
+    timeout: int
+        The default timeout for the context.
+
+    Returns
+    -------
     context: playwright.chromium.BrowserContext
-        The launched browser context.
+        The new browser context.
     """
-    browser = await p.chromium.launch(headless=headless)  # Set to True for headless mode'
     context = await browser.new_context(
         user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
         viewport={"width": 1920, "height": 1080},
         locale="en-US"
     )
+    await context.add_init_script(script="""
+        Object.defineProperty(navigator, 'webdriver', {
+            get: () => undefined
+        });
+        if (navigator.mediaDevices) {
+            Object.defineProperty(navigator.mediaDevices, 'enumerateDevices', {
+                get: () => () => []
+            });
+        }
+    """)
     context.set_default_timeout(timeout)
-    return browser, context
+    return context
 
-async def get_new_page(browser):
+async def get_context_pool(browser, n, timeout):
     """
-    Create a new page, and disable the navigator.webdriver property and the navigator.mediaDevices.enumerateDevices method.
-    
+    Create a pool of warm browser contexts, each with an already opened page.
+
     Parameters
     ----------
     browser: playwright.chromium.Browser
-        The Playwright browser instance.
-    
+        The shared browser instance.
+    n: int
+        Number of contexts in the pool.
+    timeout: int
+        The default timeout for the contexts.
+
     Returns
     -------
+    pool: asyncio.Queue of tuple
+        Queue of (context, page) pairs ready to process a dataset.
+    """
+    pool = asyncio.Queue()
+    for _ in range(n):
+        context = await new_isolated_context(browser, timeout)
+        page = await context.new_page()
+        pool.put_nowait((context, page))
+    return pool
+
+async def release_context(pool, context, page):
+    """
+    Reset a context and its page, and give them back to the pool.
+
+    Parameters
+    ----------
+    pool: asyncio.Queue of tuple
+        The pool the context was taken from.
+    context: playwright.chromium.BrowserContext
+        The context to reset.
     page: playwright.chromium.Page
-        The new page.
+        The page to reset. It is replaced by a new page if it cannot be reset.
     """
-    page = await browser.new_page()
-    await page.evaluate("""
-        if (navigator.mediaDevices) {
-            Object.defineProperty(navigator.mediaDevices, 'enumerateDevices', {
-                get: () => () => []
-            });
-        }
-    """)
-    await page.evaluate("""
-        Object.defineProperty(navigator, 'webdriver', {
-            get: () => undefined
-        });
-    """)
-    return page
-            
+    try:
+        await page.goto("about:blank")
+    except Exception:
+        await page.close()
+        page = await context.new_page()
+    await context.clear_cookies()
+    pool.put_nowait((context, page))
+
+async def close_context_pool(pool):
+    """
+    Close all the contexts of a pool.
+
+    Parameters
+    ----------
+    pool: asyncio.Queue of tuple
+        The pool of (context, page) pairs to close.
+    """
+    while not pool.empty():
+        context, _ = pool.get_nowait()
+        await context.close()
+
+def format_error(err):
+    """
+    Format an error message to be printed under its label.
+
+    Parameters
+    ----------
+    err: str
+        The error message.
+
+    Returns
+    -------
+    err_msg: str
+        The error message starting on a new line, with all lines indented.
+    """
+    return "\n" + textwrap.indent(err, " " * 7, lambda line: True)
+
+def append_errors(failed_reason, fname="error.txt"):
+    """
+    Append the errors of the failed structures to the error log, in a single write.
+
+    Parameters
+    ----------
+    failed_reason: dict of str
+        The labels of the failed structures as keys, and the error messages as values.
+    fname: str, optional
+        The path to the error log. Defaults to "error.txt".
+    """
+    with open(fname, "a") as ferror:
+        ferror.writelines(f"\n [!] Error in label = {label_i}: {format_error(err)}" for label_i, err in failed_reason.items())
+
+async def process_one(pool, data_i, v):
+    """
+    Submit a single input structure to the CMM website and download its results.
+
+    Parameters
+    ----------
+    pool: asyncio.Queue of tuple
+        Pool of (context, page) pairs shared by all the sessions.
+    data_i: Dataset
+        The dataset information, as returned by get_data.
+    v: int
+        The verbosity level.
 
-async def download_core(args):
+    Returns
+    -------
+    label_i: str
+        The label of the dataset.
+    err: str or None
+        The error message if the dataset failed, None otherwise.
+    """
+    label_i = f"{data_i.i}-{data_i.id}"
+    err = None
+    context, page = await pool.get()
+    try:
+        # Start Processing
+        if v > 1: print(f"\n - PROCESSING {data_i.i:>3} | id: {data_i.id}")
+        pdb_path, pdb_i = data_i.fpdb, data_i.pdb
+        vol_path, vol_i = data_i.fvol, data_i.vol
+        out_path = data_i.fout
+
+        # Access website and set input files
+        if v > 1: print(f"   > Accessing WEB: 'https://cmm.minorlab.org/'...")
+        await page.goto("https://cmm.minorlab.org/", timeout=TIMEOUT)
+
+        if v > 1: print(f"   > Setting PDB: {pdb_i}")
+        pdb_selector = 'input[id="pdbfile"]'  
+        await page.set_input_files(pdb_selector, pdb_path, timeout=TIMEOUT)
+
+        if v > 1: print(f"   > Setting VOL: {vol_i}")
+        vol_selector = 'input[id="densfile-2fo"]'  
+        await page.set_input_files(vol_selector, vol_path, timeout=TIMEOUT)
+
+        # Run Analysis and Download Results
+        if v > 1: print(f"   > Running Analysis...")
+        button = page.locator("#show_container > table:nth-child(3) > tbody > tr:nth-child(2) > td > table > tbody > tr:nth-child(9) > td > h5 > b > button")
+        await button.click(timeout=TIMEOUT_10m)
+        
+        if v > 1: print(f"   > Downloading Results: {out_path}")
+        async with page.expect_download(timeout=TIMEOUT_30s) as download_info:
+            await page.locator("a", has_text="JSON").first.click()
+        download = await download_info.value
+        await download.save_as(out_path)
+
+        # Validate
+        failure = await download.failure()
+        if failure is not None:
+            raise RuntimeError(f"Download failed: {failure}")
+    except Exception as e:
+        err = str(e)
+        print(f"\n [!] Error in label = {data_i}: {format_error(err)}")
+    await release_context(pool, context, page)
+    return label_i, err
+
+async def download_core(pool, args):
     """
     Download the results of the CMM analysis for a list of input structures.
 
     Parameters
     ----------
+    pool: asyncio.Queue of tuple
+        Pool of (context, page) pairs shared by all the sessions.
     args: tuple
         A tuple containing the following elements:
-            - data: list of dictionaries
-                Each dictionary contains the following keys:
-                    - 'i': int
-                        The index of the structure in the input list.
-                    - 'id': str
-                        The id of the structure.
-                    - 'fpdb': str
-                        The path to the input PDB file.
-                    - 'pdb': str
-                        The name of the input PDB file.
-                    - 'fvol': str
-                        The path to the input volume file.
-                    - 'vol': str
-                        The name of the input volume file.
-                    - 'fout': str
-                        The path to the output JSON file.
+            - data: list of Dataset
+                The structures to process, as returned by get_data.
             - v: int
                 The verbosity level.
-            - headless: bool
-                Whether to run the browser in headless mode.
 
     Returns
     -------
@@ -184,81 +350,38 @@ async def download_core(args):
 
     Notes
     -----
-    This function starts a Playwright session, and for each structure in the input list, it:
+    All the structures in the input list are processed concurrently, at most one per context in the pool.
+    For each structure, it:
         - Accesses the CMM website.
         - Sets the input files.
         - Runs the analysis.
         - Downloads the results.
         - Validates the results.
-        - Closes the page.
-    Finally, it prints the results and closes the browser.
+        - Resets the context and gives it back to the pool.
+    Finally, it prints the results.
     """
     # Get and set args
-    data, v, headless = args
+    data, v = args
 
-    # Start a Playwright session
     errors = []
-    output = {"processed": [], "success": [], "failed": [], "failed_reason": {}}
-    async with async_playwright() as p:
-        browser, context = await get_context(p, headless, TIMEOUT)
-        for data_i in data:
-            page = await get_new_page(browser)
-            try:
-                # Start Processing
-                if v > 1: print(f"\n - PROCESSING {data_i['i']:>3} | id: {data_i['id']}")
-                label_i = f"{data_i['i']}-{data_i['id']}"
-                pdb_path, pdb_i = data_i["fpdb"], data_i["pdb"]
-                vol_path, vol_i = data_i["fvol"], data_i["vol"]
-                out_path = data_i["fout"]
-
-                # Access website and set input files
-                if v > 1: print(f"   > Accessing WEB: 'https://cmm.minorlab.org/'...")
-                await page.goto("https://cmm.minorlab.org/", timeout=TIMEOUT)
-
-                if v > 1: print(f"   > Setting PDB: {pdb_i}")
-                pdb_selector = 'input[id="pdbfile"]'  
-                await page.set_input_files(pdb_selector, pdb_path, timeout=TIMEOUT)
-
-                if v > 1: print(f"   > Setting VOL: {vol_i}")
-                vol_selector = 'input[id="densfile-2fo"]'  
-                await page.set_input_files(vol_selector, vol_path, timeout=TIMEOUT)
-
-                # Run Analysis and Download Results
-                if v > 1: print(f"   > Running Analysis...")
-                button = page.locator("#show_container > table:nth-child(3) > tbody > tr:nth-child(2) > td > table > tbody > tr:nth-child(9) > td > h5 > b > button")
-                await button.click(timeout=TIMEOUT_10m)
-                
-                if v > 1: print(f"   > Downloading Results: {out_path}")
-                async with page.expect_download() as download_info:
-                    await page.eval_on_selector("a:has-text('JSON')", "el => el.click()")
-                download = await download_info.value
-                await download.save_as(out_path)
-                await page.wait_for_load_state(timeout=TIMEOUT_30s)
-
-                # Validate
-                if not os.path.exists(out_path):
-                    raise FileNotFoundError(f"Could not find downloaded file.")
-                output["success"].append(label_i)
-            except Exception as e:
-                err_msg = "\n" + str(e)
-                err_msg = err_msg.replace("\n", "\n       ")
-                print(f"\n [!] Error in label = {data_i}: {err_msg}")
-                errors.append(label_i)
-                output["failed"].append(label_i)
-                output["failed_reason"][label_i] = str(e)
-                with open("error.txt", "a") as ferror:
-                    ferror.write(f"\n [!] Error in label = {label_i}: {err_msg}")
-            output["processed"].append(label_i)
-            await page.close()
-
-        # Close the browser
-        await browser.close()
-
-        # Print results
-        if v > 1:
-            print(f" - Successfully downloaded {len(data) - len(errors)} out of {len(data)}")
-            print(f" - The following ids failed:\n     > {errors}")
+    output = {"processed": deque(), "success": deque(), "failed": deque(), "failed_reason": {}}
+    results = await asyncio.gather(*[process_one(pool, data_i, v) for data_i in data])
+    for label_i, err in results:
+        if err is None:
+            output["success"].append(label_i)
+        else:
+            errors.append(label_i)
+            output["failed"].append(label_i)
+            output["failed_reason"][label_i] = err
+        output["processed"].append(label_i)
+    if errors: await asyncio.to_thread(append_errors, output["failed_reason"])
+
+    # Print results
+    if v > 1:
+        print(f" - Successfully downloaded {len(data) - len(errors)} out of {len(data)}")
+        print(f" - The following ids failed:\n     > {errors}")
 
+    output = {key: (list(val) if isinstance(val, deque) else val) for key, val in output.items()}
     return output, errors
 
 async def submit(data, v=0, n_cpus=1, n_files_per_div=1, headless=True):
@@ -267,16 +390,16 @@ async def submit(data, v=0, n_cpus=1, n_files_per_div=1, headless=True):
 
     Parameters
     ----------
-    data : list of str
-        A list of paths to input files.
+    data : list of Dataset
+        The datasets to submit, as returned by get_data.
     v : int, optional
         Verbosity level. 0 is silent, 1 prints a progress bar, 2 prints a
         progress bar and each file processed, and 3 prints all output.
         Defaults to 0.
     n_cpus : int, optional
-        Number of CPUs to use for parallel processing. Defaults to 1.
+        Number of parallel sessions (browser contexts) to use. Defaults to 1.
     n_files_per_div : int, optional
-        Number of files to divide into a single parallel session. Defaults to 1.
+        Number of files taken at once by a parallel worker. Defaults to 1.
     headless : bool, optional
         Whether to run the browser in headless mode. Defaults to True.
 
@@ -291,43 +414,50 @@ async def submit(data, v=0, n_cpus=1, n_files_per_div=1, headless=True):
     errors : list of str
         A list of ids of files that failed.
     """
+    from playwright.async_api import async_playwright
+
     n_data = len(data)
     if n_cpus > 4: raise ValueError("Number of parallel sessions cannot be higher than 4.")
-    if n_cpus == 1:
-        output, errors = await download_core((data, v, headless))
-    else:
-        args = []
-        div = math.ceil(n_data/n_files_per_div)
-        for i in range(div):
-            n_min = i*n_files_per_div
-            n_max = (i+1)*n_files_per_div
-            if n_min >= n_data: break
-            if n_max >= n_data: n_max = n_data
-            args.append((data[n_min:n_max], 0, True))
-
-        semaphore = asyncio.Semaphore(n_cpus)
-        async def download_core_limited(arg):
-            async with semaphore:
-                return await download_core(arg)
-        results = await tqdm_asyncio.gather(*[download_core_limited(arg) for arg in args], desc=" - Process")
-        
-        errors = []
-        output = {"processed": [], "success": [], "failed": [], "failed_reason": {}}
-        dtypes = {"processed": list, "success": list, "failed": list, "failed_reason": dict}
-        dkeys = list(output.keys())
-        pbar = tqdm(total=len(results), desc=" - Merging", ascii=True, unit=" split", unit_scale=True, ncols=80)
-        for d, e in results:
-            errors.extend(e)
-            for key in dkeys:
-                if dtypes[key] == list: output[key].extend(d[key])
-                else: output[key].update(d[key])
-            pbar.update(1)
-        pbar.close()
-
-        # Print results
-        print(f" - Successfully downloaded {len(data) - len(errors)} out of {len(data)}")
-        if len(errors) > 0: print(f" - The following ids failed:\n   > {errors}")
-        else: print(f" - No errors")
+
+    # Start a Playwright session with a single browser shared by all the sessions
+    async with async_playwright() as p:
+        browser = await get_browser(p, headless)
+        pool = await get_context_pool(browser, n_cpus, TIMEOUT)
+        if n_cpus == 1:
+            output, errors = await download_core(pool, (data, v))
+        else:
+            from tqdm import tqdm
+
+            # Stream the splits to n_cpus long-lived workers, so a free worker picks the next split
+            splits = [(data[i:i+n_files_per_div], 0) for i in range(0, n_data, n_files_per_div)]
+            queue = asyncio.Queue()
+            for idx_arg in enumerate(splits):
+                queue.put_nowait(idx_arg)
+
+            results = [None] * len(splits)
+            pbar = tqdm(total=n_data, desc=" - Process")
+            async def worker():
+                while not queue.empty():
+                    idx, arg = queue.get_nowait()
+                    results[idx] = await download_core(pool, arg)
+                    pbar.update(len(arg[0]))
+            await asyncio.gather(*[worker() for _ in range(n_cpus)])
+            pbar.close()
+
+            errors = list(chain.from_iterable(e for _, e in results))
+            output = {key: list(chain.from_iterable(d[key] for d, _ in results)) for key in ("processed", "success", "failed")}
+            output["failed_reason"] = {}
+            for d, _ in results:
+                output["failed_reason"].update(d["failed_reason"])
+
+            # Print results
+            print(f" - Successfully downloaded {len(data) - len(errors)} out of {len(data)}")
+            if len(errors) > 0: print(f" - The following ids failed:\n   > {errors}")
+            else: print(f" - No errors")
+
+        # Close the contexts and the browser
+        await close_context_pool(pool)
+        await browser.close()
 
     return output, errors
 
@@ -335,6 +465,8 @@ def save_json(data, fname):
     """
     Save the given data to a json file.
 
+    Uses orjson when it is installed, and the standard json module otherwise.
+
     Parameters
     ----------
     data : dict or list
@@ -347,8 +479,12 @@ def save_json(data, fname):
     None
     """
     print(f" - Saving results")
-    with open(fname, "w") as f:
-        json.dump(data, f, indent=4)
+    if orjson is not None:
+        with open(fname, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(fname, "w") as f:
+            json.dump(data, f, indent=2)
     print(f"   Stored at {fname}")
 
 def dry(data, args):
@@ -357,7 +493,7 @@ def dry(data, args):
 
     Parameters
     ----------
-    data : list of dict
+    data : list of Dataset
         The data to submit.
     args : list of str
         The command-line arguments.
@@ -371,4 +507,4 @@ def dry(data, args):
     print(f"   Number of folders: {len(data)}")
     if len(data) > 0:
         print(f"   Data[0]:")
-        print(json.dumps(data[0], indent=4))
\ No newline at end of file
+        print(json.dumps(asdict(data[0]), indent=4))
\ No newline at end of file